@@ -24,6 +24,7 @@ will behave in a funny way. This happens hopefully only when only 8 colors are s
 import functools as _functools
 import sys as _sys
 import warnings as _warnings
+import weakref as _weakref
 
 # this script requires Python 3
 
@@ -36,6 +37,10 @@ C_COLOR_OPTION_LIST = (C_COLOR_OFF, C_COLOR_ON, C_COLOR_AUTO, C_COLOR_ANSI)
 
 _useColorFlag = C_COLOR_AUTO
 
+# willPrintColor() results used by printc, per file. Cleared by enableColorPrinting().
+# Weak keys, so files are still closed when the caller drops them.
+_will_print = _weakref.WeakKeyDictionary()
+
 _ctable = (
     'black'  ,
     'blue'   ,
@@ -53,8 +58,18 @@ _C_RESET_FG_FLAG = 0x400
 _C_RESET_BG_FLAG = 0x800
 _C_RESET_ALL_FLAG = 0x1000 # separate, since ANSI has a reset all function
 
-_all_flags = C_BRIGHT_FLAG, _C_RESET_BRIGHT_FLAG, _C_RESET_FG_FLAG, _C_RESET_BG_FLAG, _C_RESET_ALL_FLAG
-_all_flags_str = 'C_BRIGHT_FLAG', '_C_RESET_BRIGHT_FLAG', '_C_RESET_FG_FLAG', '_C_RESET_BG_FLAG', '_C_RESET_ALL_FLAG'
+_FLAG_NAMES = {
+    C_BRIGHT_FLAG        : 'C_BRIGHT_FLAG',
+    _C_RESET_BRIGHT_FLAG : '_C_RESET_BRIGHT_FLAG',
+    _C_RESET_FG_FLAG     : '_C_RESET_FG_FLAG',
+    _C_RESET_BG_FLAG     : '_C_RESET_BG_FLAG',
+    _C_RESET_ALL_FLAG    : '_C_RESET_ALL_FLAG' }
+
+# descriptions of the flags which apply to the foreground, for str(Color)
+_FLAG_LABELS = (
+    (C_BRIGHT_FLAG,        'bold'),
+    (_C_RESET_BRIGHT_FLAG, 'non-bold'),
+    (_C_RESET_FG_FLAG,     'non-colored') )
 
 def colorname(i):
     """ Returns the name of a color
@@ -63,13 +78,16 @@ def colorname(i):
     return _ctable[i]
 
 
+# names of colors 0 to 15, for str(Color)
+_COLOR_NAMES = _ctable + tuple("bright " + name for name in _ctable)
+
 def _color_to_str(n):
     """ integer color number to string """
-    if n < 16:
-        return ("bright " if (n & 8) else "") + _ctable[n % 8]
-    return str(n)
+    return _COLOR_NAMES[n] if n < 16 else str(n)
+
+# shared Color instances for colors 0 to 15, keyed by (fg, bg, flag)
+_interned = {}
 
-@_functools.total_ordering
 class Color:
     """
     Represent a change in color. This can be:
@@ -97,22 +115,57 @@ class Color:
 
     `printc(C_BLUE, C_BRIGHT, "text")` in ANSI or curses mode still represents 2 separate color operations: set the color to 1, and then set the bold attribute.
     """
+    # ANSI escape sequence and Win32 console attribute, filled in on first use. Set to None
+    # whenever the color changes.
+    _ansi = None
+    _win_attr = None
+
+    @staticmethod
     def make(fg, bg, flag=0):
         """ create color with given foreground and background colors (given as integers) """
-        c = Color()
+        c = _interned.get((fg, bg, flag))
+        if c is not None:
+            return c
+        c = object.__new__(Color)
         c.fg = fg
         c.bg = bg
         c.flag = flag
+        c._bool = (fg is not None or bg is not None or flag != 0)
+        c._hash = hash((fg, bg, flag))
+        return c._intern()
+
+    def _intern(self):
+        """ returns the shared instance for this color if it uses colors 0 to 15 only.
+
+        Colors returned by this function must not be modified any more. """
+        if (self.fg is None or self.fg < 16) and (self.bg is None or self.bg < 16):
+            return _interned.setdefault(self._key(), self)
+        return self
+
+    @staticmethod
+    def _clone(src):
+        """ copy a color object, without going through __init__ """
+        c = object.__new__(Color)
+        c.fg = src.fg
+        c.bg = src.bg
+        c.flag = src.flag
+        c._bool = src._bool
+        c._hash = src._hash
         return c
 
+    @staticmethod
     def fg(color, intensity=None):
         """ create color with given foreground color (given as integer) """
-        return Color.make(Color._val(color, intensity), None)
+        a = Color._val(color, intensity)
+        return _FG_CACHE[a] if 0 <= a < 256 else Color.make(a, None)
 
+    @staticmethod
     def bg(color, intensity=None):
         """ create color with given background color (given as integer) """
-        return Color.make(None, Color._val(color, intensity))
+        a = Color._val(color, intensity)
+        return _BG_CACHE[a] if 0 <= a < 256 else Color.make(None, a)
 
+    @staticmethod
     def fg6(r, g, b):
         """ create color with given 6-level RGB values (0−5) """
         r, g, b = int(r), int(g), int(b)
@@ -121,6 +174,7 @@ class Color:
         color = 16 + b + 6*(g + 6*r)
         return Color.make(color, None)
 
+    @staticmethod
     def bg6(r, g, b):
         """ create color with given 6-level RGB values (0−5) as background color """
         r, g, b = int(r), int(g), int(b)
@@ -129,6 +183,7 @@ class Color:
         color = 16 + b + 6*(g + 6*r)
         return Color.make(None, color)
 
+    @staticmethod
     def fg24(r, g, b, intensity=None):
         """ create color as 24-bit RGB (0−255) """
         r, g, b = int(r), int(g), int(b)
@@ -137,6 +192,7 @@ class Color:
         color = 0xff000000 + b + 256*(g + 256*r)
         return Color.make(color, None)
 
+    @staticmethod
     def bg24(r, g, b, intensity=None):
         """ create color with 24-bit RGB (0−255) as background color """
         r, g, b = int(r), int(g), int(b)
@@ -153,27 +209,21 @@ class Color:
 
         For constructing a color using an int, see fg() and bg() and their variants.
         """
-        # foreground color, if set
-        # values 0 to 256 refer to some 256 color palette
-        # values 0xff000000 and above are 32-bit ARGB values (with A set to
-        # 255 to distinguish it from the 256-color palette).
-        self.fg = None
-        # background color, if set
-        # values 0 to 256 refer to some 256 color palette
-        # values 0xff000000 and above are 32-bit ARGB values (with A set to
-        # 255 to distinguish it from the 256-color palette).
-        self.bg = None
-        # flags: now used to create a color object which just switches on
-        # the intensity bit (C_BRIGHT, or 'bold' on ANSI)
-        self.flag = 0
-
+        # fg: foreground color, if set
+        # bg: background color, if set
+        #     values 0 to 256 refer to some 256 color palette
+        #     values 0xff000000 and above are 32-bit ARGB values (with A set to
+        #     255 to distinguish it from the 256-color palette).
+        # flag: now used to create a color object which just switches on
+        #     the intensity bit (C_BRIGHT, or 'bold' on ANSI)
+        # _bool, _hash: cached values of bool(self) and hash(self)
         if color is None:
-            return
+            self.fg, self.bg, self.flag, self._bool = None, None, 0, False
+            self._hash = hash((None, None, 0))
         else:
             # copy fields
-            self.fg = color.fg
-            self.bg = color.bg
-            self.flag = color.flag
+            self.fg, self.bg, self.flag, self._bool = color.fg, color.bg, color.flag, color._bool
+            self._hash = color._hash
 
     def with_fg(self, color, intensity=None):
         """ return a color with the same background, but a different foreground """
@@ -188,16 +238,17 @@ class Color:
         Returns a version with a bright foreground color (for colors 0 to 7), or with bold text.
 
         As a special case, C_RESET.bright() returns C_BRIGHT. """
-        c = Color(self)
+        c = Color._clone(self)
         c._apply_flags(C_BRIGHT_FLAG)
-        return c
+        return c._intern()
 
     def dark(self):
         """ returns a version with a dark foreground color for colors 8 to 15. """
-        c = Color(self)
+        c = Color._clone(self)
         c.flag = 0
         if c.fg and c.fg < 16: c.fg = c.fg % 8
-        return c
+        c._changed()
+        return c._intern()
 
     def bright_bg(self):
         """ returns a version with a bright background color for colors 0 to 7 """
@@ -207,15 +258,13 @@ class Color:
         """ returns a version with a dark background color for colors 8 to 15"""
         return self.with_bg(self.bg or 0, False)
 
+    @staticmethod
     def _val(color, intensity):
         """ Get a valid color value and optionally set the 'intensity'. """
-        a = int(color)
-        if a < 16:
-            if intensity:
-                a = a | 8
-            elif intensity is not None:
-                a = a & 7
-        return a
+        a = color if type(color) is int else int(color)
+        if intensity is None or a > 15:
+            return a
+        return a | 8 if intensity else a & 7
 
     def _apply_flags(self, new_flags):
         """ Apply new flags to this Color instance
@@ -245,12 +294,20 @@ class Color:
                 self.fg -= 8
 
         self.flag |= new_flags
+        self._changed()
+
+    def _changed(self):
+        """ Update cached values after changing fg, bg or flag """
+        self._ansi = None
+        self._win_attr = None
+        self._bool = (self.fg is not None or self.bg is not None or self.flag != 0)
+        self._hash = hash(self._key())
 
     def _add(self, b):
-        c = Color(self)
         if b.flag & _C_RESET_ALL_FLAG:
-            return Color.make(None, None, _C_RESET_ALL_FLAG)
+            return C_RESET
 
+        c = Color._clone(self)
         c.flag &= ~_C_RESET_ALL_FLAG
         if b.fg is not None:
             c.fg = int(b.fg)
@@ -259,83 +316,100 @@ class Color:
             c.flag &= ~_C_RESET_BG_FLAG
             c.bg = int(b.bg)
         c._apply_flags(b.flag)
-        return c
+        return c._intern()
 
     # a + b: apply b after a
     def __add__(a, b):
-        if not b: return Color(a)
-        try:
-            return a._add(b)
-        except AttributeError:
+        if not b: return a
+        if not isinstance(b, Color):
             raise ValueError("Can't add Color to "+b.__class__.__name__)
+        return a._add(b)
 
     # a + b: apply b after a
     def __radd__(b, a):
-        if not a: return Color(b)
-        try:
-            return a._add(b)
-        except AttributeError:
+        if not a: return b
+        if not isinstance(a, Color):
             raise ValueError("Can't add Color to "+a.__class__.__name__)
+        return a._add(b)
 
     # bool(self)
     def __bool__(self):
-        return (self.fg is not None or self.bg is not None or self.flag != 0)
+        return self._bool
 
     # repr(self)
     def __repr__(self):
         # with flag:
         if self.flag:
-            s = [y for x, y in zip(_all_flags, _all_flags_str) if self.flag & x]
-            return  'Color({}, {}, {})'.format(self.fg, self.bg, ' | '.join(s))
+            s = ' | '.join(n for f, n in _FLAG_NAMES.items() if self.flag & f)
+            return  'Color({}, {}, {})'.format(self.fg, self.bg, s)
         # regular color, or None
         return 'Color({}, {})'.format(self.fg, self.bg)
 
     # str(self)
     def __str__(self):
-        # reset:
-        if not self:
-            return []
+        # no change:
+        if not self._bool:
+            return '[]'
         if self.flag & _C_RESET_ALL_FLAG:
             return '[reset]'
 
-        s = []
-        if self.flag & C_BRIGHT_FLAG:
-            s.append('bold')
-        if self.flag & _C_RESET_BRIGHT_FLAG:
-            s.append('non-bold')
-        if self.flag & _C_RESET_FG_FLAG:
-            s.append('non-colored')
-        if self.fg:
+        s = [label for f, label in _FLAG_LABELS if self.flag & f]
+        if self.fg is not None:
             s.append(_color_to_str(self.fg))
-        s = ' '.join(s)
-        if self.bg:
-            if s: s += ', '
-            s += _color_to_str(self.bg) + ' background'
+        parts = [' '.join(s)] if s else []
+        if self.bg is not None:
+            parts.append(_color_to_str(self.bg) + ' background')
         if self.flag & _C_RESET_BG_FLAG:
-            if s: s += ', '
-            s.append('no background')
-        return '[' + s + ']'
+            parts.append('no background')
+        return '[' + ', '.join(parts) + ']'
+
+    def _key(self):
+        return (self.fg, self.bg, self.flag)
 
     # hash(self)
     def __hash__(self):
-        return hash(self.fg, self.bg, self.flag)
+        return self._hash
 
     # a == b
     def __eq__(a, b):
-        try:
-            return (a.fg   == b.fg   and
-                    a.bg   == b.bg   and
-                    a.flag == b.flag )
-        except AttributeError:
+        if not isinstance(b, Color):
             return NotImplemented
+        return a._key() == b._key()
+
+    def _order(self):
+        """ sort key: like _key(), with None sorted before all colors """
+        return (-1 if self.fg is None else self.fg,
+                -1 if self.bg is None else self.bg,
+                self.flag)
 
-    # a < b
+    # a < b, etc.: an arbitrary but consistent order, so colors can be sorted
     def __lt__(a, b):
-        return a.__hash__() < b.__hash__()
+        if not isinstance(b, Color):
+            return NotImplemented
+        return a._order() < b._order()
+
+    def __le__(a, b):
+        if not isinstance(b, Color):
+            return NotImplemented
+        return a._order() <= b._order()
+
+    def __gt__(a, b):
+        if not isinstance(b, Color):
+            return NotImplemented
+        return a._order() > b._order()
+
+    def __ge__(a, b):
+        if not isinstance(b, Color):
+            return NotImplemented
+        return a._order() >= b._order()
 
 
 # color numbers
 
+# shared Color instances for Color.fg() and Color.bg() with palette entries 0 to 255
+_FG_CACHE = tuple(Color.make(i, None) for i in range(256))
+_BG_CACHE = tuple(Color.make(None, i) for i in range(256))
+
 #: Color object that represents no action to change color
 C_NO_COLOR = Color()
 #: reset all attributes
@@ -385,67 +459,121 @@ def enableColorPrinting(flag):
     These values are stored in the tuple `C_COLOR_OPTION_LIST` so you can easily present them as
     choises for eg. argparse options.
     """
-    global _useColorFlag
+    global _useColorFlag, _need_flush
     if flag not in C_COLOR_OPTION_LIST:
         raise ValueError("flag not in "+", ".join(C_COLOR_OPTION_LIST))
+    _will_print.clear()
     if flag == C_COLOR_ANSI:
         _useColorFlag = C_COLOR_ON
         _use_ansi_fallback()
-        _need_flush = False
+        _need_flush = ()
     else:
         _useColorFlag = flag
 
 
-def _set_color_raw_ansi(color, f):
-    """ Sets current color using ANSI codes
+def _print_el_raw(file, s, con=None):
+    """ Writes text and ANSI sequences to the file as is """
+    file.write(s)
+
+
+# ANSI escape sequences, keyed by (fg, bg, flag). Only palette colors are stored, 24-bit colors
+# keep theirs in Color._ansi only, so this can't grow without bound.
+_ansi_cache = {}
+
+def _set_color_raw_ansi(color, f, buf, con=None):
+    """ Sets current color using ANSI codes, by appending them to the output buffer
 
     Used on Windows 10 in ANSI mode, or as a fallback if neither WIN32 or curses are available. """
-    if color.flag & _C_RESET_ALL_FLAG:
-        _print_el(f, '\033[0m')
-        return
+    s = color._ansi
+    if s is None:
+        key = (color.fg, color.bg, color.flag)
+        s = _ansi_cache.get(key)
+        if s is None:
+            s = _ansi_escape(*key)
+            if (color.fg is None or color.fg < 256) and (color.bg is None or color.bg < 256):
+                _ansi_cache[key] = s
+        color._ansi = s
+    buf.append(s)
+
+
+# color 0 to 15 in Windows order (blue is 1) to ANSI order (red is 1)
+_RGB_BIT_SWAP = bytes(((i & 1) << 2) + (i & 2) + ((i & 4) >> 2) + (i & 8) for i in range(16))
+
+# ANSI SGR codes for colors 0 to 15, and the full escape sequences for those colors
+_FG_CODES = tuple(('9' if i >= 8 else '3') + str(_RGB_BIT_SWAP[i & 7]) for i in range(16))
+_BG_CODES = tuple(('10' if i >= 8 else '4') + str(_RGB_BIT_SWAP[i & 7]) for i in range(16))
+_FG_ANSI = tuple('\033[' + c + 'm' for c in _FG_CODES)
+_BG_ANSI = tuple('\033[' + c + 'm' for c in _BG_CODES)
+
+def _fg_code(fg):
+    """ ANSI SGR parameters for a foreground color """
+    if fg < 16:
+        return _FG_CODES[fg]
+    if fg < 256:
+        return '38;5;{}'.format(fg)
+    return '38;2;{};{};{}'.format((fg >> 16) & 0xff, (fg >> 8) & 0xff, fg & 0xff)
+
+def _bg_code(bg):
+    """ ANSI SGR parameters for a background color """
+    if bg < 16:
+        return _BG_CODES[bg]
+    if bg < 256:
+        return '48;5;{}'.format(bg)
+    return '48;2;{};{};{}'.format((bg >> 16) & 0xff, (bg >> 8) & 0xff, bg & 0xff)
+
+def _ansi_escape(fg, bg, flag):
+    """ Returns the ANSI escape sequence for this color """
+    if flag & _C_RESET_ALL_FLAG:
+        return '\033[0m'
+
+    # common cases: only colors
+    if not flag:
+        if fg is not None:
+            if bg is None:
+                return _FG_ANSI[fg] if fg < 16 else '\033[' + _fg_code(fg) + 'm'
+            return '\033[{};{}m'.format(_fg_code(fg), _bg_code(bg))
+        if bg is not None:
+            return _BG_ANSI[bg] if bg < 16 else '\033[' + _bg_code(bg) + 'm'
 
     ansi = []
 
-    if color.flag & C_BRIGHT_FLAG:
+    if flag & C_BRIGHT_FLAG:
         ansi.append('1')
-    elif color.flag & _C_RESET_BRIGHT_FLAG:
+    elif flag & _C_RESET_BRIGHT_FLAG:
         ansi.append('22')
 
-    if color.flag & _C_RESET_FG_FLAG:
+    if flag & _C_RESET_FG_FLAG:
         ansi.append('39')
-    elif color.fg is not None:
-        if color.fg < 16:
-            intensity = (color.fg >= 8)
-            ansiC = ((color.fg & 1) << 2) + (color.fg & 2) + ((color.fg & 4) >> 2)
-            ansi.append(('9' if intensity else '3') + str(ansiC))
-        elif color.fg < 256:
-            ansi.append('38;5')
-            ansi.append(str(color.fg))
-        else:
-            ansi.append('38;2')
-            ansi.append(str((color.fg >> 16) & 0xff))
-            ansi.append(str((color.fg >>  8) & 0xff))
-            ansi.append(str((color.fg      ) & 0xff))
+    elif fg is not None:
+        ansi.append(_fg_code(fg))
 
-    if color.flag & _C_RESET_BG_FLAG:
+    if flag & _C_RESET_BG_FLAG:
         ansi.append('49')
-    elif color.bg is not None:
-        if color.bg < 16:
-            intensity = (color.bg >= 8)
-            ansiC = ((color.bg & 1) << 2) + (color.bg & 2) + ((color.bg & 4) >> 2)
-            ansi.append(('10' if intensity else '4') + str(ansiC))
-        elif color.bg < 256:
-            ansi.append('48;5')
-            ansi.append(str(color.bg))
-        else:
-            ansi.append('48;2')
-            ansi.append(str((color.bg >> 16) & 0xff))
-            ansi.append(str((color.bg >>  8) & 0xff))
-            ansi.append(str((color.bg      ) & 0xff))
+    elif bg is not None:
+        ansi.append(_bg_code(bg))
 
-    _print_el(f, '\033[' + ';'.join(ansi) + 'm')
+    return '\033[' + ';'.join(ansi) + 'm'
 
 
+# build the escape sequences for all combinations of colors 0 to 15, with or without bold,
+# right away. Those are the vast majority of the colors used.
+for _fg in (None,) + tuple(range(16)):
+    for _bg in (None,) + tuple(range(16)):
+        for _flag in (0, C_BRIGHT_FLAG):
+            _ansi_cache[(_fg, _bg, _flag)] = _ansi_escape(_fg, _bg, _flag)
+del _fg, _bg, _flag
+
+# the predefined colors are used all the time: fill in their escape sequences as well
+for _c in (C_RESET, C_BRIGHT, C_RESET_BRIGHT, C_RESET_FG, C_RESET_BG,
+           C_BLACK, C_BLUE, C_GREEN, C_CYAN, C_RED, C_MAGENTA, C_YELLOW, C_WHITE,
+           C_BG_BLACK, C_BG_BLUE, C_BG_GREEN, C_BG_CYAN, C_BG_RED, C_BG_MAGENTA, C_BG_YELLOW, C_BG_WHITE):
+    _c._ansi = _ansi_cache.setdefault(_c._key(), _ansi_escape(*_c._key()))
+del _c
+
+
+# 8-bit channel value to a level in the 6x6x6 color cube
+_CUBE_LEVEL = bytes((i + 20) // 51 for i in range(256))
+
 def _reduce_256(n):
     """ return a color value from our 256-color palette."""
     if n < 256:
@@ -457,21 +585,17 @@ def _reduce_256(n):
 
     a1 = min(r, g, b)
     a2 = max(r, g, b)
-    if abs(a1 - a2) < 20:
+    if a2 - a1 < 20:
         return min(255, 232 + (a1 + a2) // 16)
 
-    r = (r + 20) // 51
-    g = (g + 20) // 51
-    b = (b + 20) // 51
-
-    return 16 + b + 6*(g + 6*r)
+    return 16 + _CUBE_LEVEL[b] + 6*(_CUBE_LEVEL[g] + 6*_CUBE_LEVEL[r])
 
-def _reduce_16(n):
-    """ return a color value between 0 and 15 that approximates the given value."""
+def _reduce_16_palette(n):
+    """ return a color value between 0 and 15 that approximates the given palette entry (0 to 255)."""
     if n < 16:
         return n
 
-    if n > 231 and n < 256:
+    if n > 231:
         if n < 235:
             return 0
         if n < 242:
@@ -480,16 +604,11 @@ def _reduce_16(n):
             return 7
         return 15
 
-    if n > 256:
-        red   = ((n & 0xff) + 20) // 51
-        green = (((n >> 8) & 0xff) + 20) // 51
-        blue  = (((n >> 16) & 0xff) + 20) // 51
-    else:
-        n -= 16
-        red = n // 36
-        n -= 36*red
-        green = n // 6
-        blue = n - 6*green
+    n -= 16
+    red = n // 36
+    n -= 36*red
+    green = n // 6
+    blue = n - 6*green
 
     col = 0
     if (blue >= max(green, red) - 1): col = col | 1
@@ -507,6 +626,16 @@ def _reduce_16(n):
 
     return col
 
+_PALETTE_TO_16 = bytes(_reduce_16_palette(i) for i in range(256))
+
+def _reduce_16(n):
+    """ return a color value between 0 and 15 that approximates the given value."""
+    if n < 256:
+        return _PALETTE_TO_16[n]
+
+    # 24-bit colors: go through the nearest entry of the 256-color palette
+    return _PALETTE_TO_16[_reduce_256(n)]
+
 
 def _reduce(cols, n):
     if cols <= 16:
@@ -521,13 +650,27 @@ def _use_ansi_fallback():
     """ Switch to ANSI printing. (can't undo this) """
     global _colorMode, _colors, _can_use, _print_el, _set_color
 
-    _colorMode = lambda file : "ANSI"
-    _colors = lambda file : 0x1000000
-    _can_use = lambda file: True
-    _print_el = lambda file, s: print(file=file, end=s)
+    def _colorMode(file):
+        return "ANSI"
+
+    def _colors(file):
+        return 0x1000000
+
+    def _can_use(file):
+        return True
+
+    _print_el = _print_el_raw
     _set_color = _set_color_raw_ansi
 
 
+def _con_for(file):
+    """ Console state for this file, if any.
+
+    printc() looks this up once and passes it on to _set_color and _print_el. Only Windows has
+    per-file console state. """
+    return None
+
+
 if _sys.platform == 'win32':
 
     # use Windows-specific color stuff
@@ -594,22 +737,26 @@ if _sys.platform == 'win32':
                         self.use_ansi = True
             else:
                 self.default = C_WHITE + C_BG_BLACK
-            self.color   = Color(self.default) # copy
+            self.color   = Color._clone(self.default)
+
+    # only the original stdout and stderr can be consoles
+    _stdout, _stderr = _sys.stdout, _sys.stderr
+    _con_stdout = _Con(_STD_OUTPUT_HANDLE)
+    _con_stderr = _Con(_STD_ERROR_HANDLE)
 
-    _std_h = ((_sys.stdout, _STD_OUTPUT_HANDLE),
-              (_sys.stderr, _STD_ERROR_HANDLE))
-    _con = { f[0] : _Con(f[1]) for f in _std_h }
+    def _con_for(file):
+        return _con_stdout if file is _stdout else (_con_stderr if file is _stderr else None)
 
     def _istty(file):
-        c = _con.get(file)
+        c = _con_for(file)
         return c is not None and c.istty
 
     def _colors(file):
-        c = _con.get(file)
+        c = _con_for(file)
         return 1 if c is None else (0x1000000 if c.use_ansi else 16)
 
     def _colorMode(file):
-        c = _con.get(file)
+        c = _con_for(file)
         return "None" if c is None else ("ANSI" if c.use_ansi else "win32")
 
     def _can_use(file):
@@ -618,38 +765,50 @@ if _sys.platform == 'win32':
 
     # using WriteConsoleW also solves this stupid UnicodeEncodeError on printing fancy characters. It
     # is however slower than print().
-    def _print_el(file, s):
-        con = _con[file]
+    def _print_el(file, s, con=None):
+        if con is None: con = _con_for(file)
         if con.use_ansi:
-            print(end=s)
+            file.write(s)
         else:
             n = _ctypes.c_int(0)
-            utf16 = s.encode('utf-16-le') # we need to count 2 'code' units for characters beyond U+FFFF
-            _writeConsole(con.h, s, len(utf16) // 2, _ctypes.byref(n), None)
+            units = len(s)
+            if not s.isascii() and max(s) > '\uffff':
+                # we need to count 2 'code' units for characters beyond U+FFFF
+                units = len(s.encode('utf-16-le')) // 2
+            _writeConsole(con.h, s, units, _ctypes.byref(n), None)
 
 
-    def _set_color(color, f):
-        con = _con[f]
+    def _set_color(color, f, buf, con=None):
+        if con is None: con = _con_for(f)
         if con.use_ansi:
-            _set_color_raw_ansi(color, f)
+            _set_color_raw_ansi(color, f, buf, con)
             return
 
+        # the console attribute applies to text written from here on, so
+        # write out what we have so far
+        if buf:
+            _print_el(f, ''.join(buf), con)
+            buf.clear()
+
         if color.flag & _C_RESET_ALL_FLAG:
             color = con.default
         else:
             color = con.color + color
             # handle reset color flags
-            if color.fg is None: color.fg = con.default.fg
-            if color.bg is None: color.bg = con.default.bg
-            color.flag &= ~_C_RESET_FG_FLAG
-            color.flag &= ~_C_RESET_BG_FLAG
+            color = Color.make(con.default.fg if color.fg is None else color.fg,
+                               con.default.bg if color.bg is None else color.bg,
+                               color.flag & ~(_C_RESET_FG_FLAG | _C_RESET_BG_FLAG))
 
         con.color = color
-        fg, bg = _reduce_16(color.fg), _reduce_16(color.bg)
-        attr = fg + bg * 16
+        attr = color._win_attr
+        if attr is None:
+            attr = color._win_attr = _reduce_16(color.fg) + 16 * _reduce_16(color.bg)
         bool = _setConsoleTextAttribute(con.h, attr)
 
-    _need_flush = any(c.istty and not c.use_ansi for _, c in _con.items())
+    # files written with WriteConsoleW: flush these first, so earlier print() output comes out
+    # before ours
+    _need_flush = tuple(f for f, c in ((_stdout, _con_stdout), (_stderr, _con_stderr))
+                        if c.istty and not c.use_ansi)
 
 # Unix and Windows/msys
 else:
@@ -657,8 +816,7 @@ else:
     def _istty(file):
         return file.isatty()
 
-    def _print_el(file, s):
-        print(file=file, end=s)
+    _print_el = _print_el_raw
 
     try:
         import curses as _cu
@@ -676,6 +834,10 @@ else:
         _colbold = _cu.tigetstr("bold").decode('ascii')
         _colreset =  _cu.tigetstr("sgr0").decode('ascii')
 
+        # setaf and setab output for every palette color, so we only call tparm once per color
+        _afcodes = tuple(_cu.tparm(_afstr, i).decode('ascii') for i in range(min(_cols, 256)))
+        _abcodes = tuple(_cu.tparm(_abstr, i).decode('ascii') for i in range(min(_cols, 256)))
+
         def _can_use(file):
             return _cols and _cols >= 8
 
@@ -685,50 +847,54 @@ else:
         def _colorMode(file):
             return "Curses" if _cols >= 8 else "None"
 
-        def _set_color(color, f):
-            if color.flag & _C_RESET_ALL_FLAG:
-                _print_el(f, _colreset)
-                return
+        def _set_color(color, f, buf, con=None):
+            buf.append(_curses_escape(color.fg, color.bg, color.flag))
+
+        @_functools.lru_cache(maxsize=512)
+        def _curses_escape(fg, bg, flag):
+            """ Returns the escape sequences to set this color, using terminfo """
+            if flag & _C_RESET_ALL_FLAG:
+                return _colreset
 
-            if color.flag & C_BRIGHT_FLAG:
-                _print_el(f, _colbold)
-            elif color.flag & _C_RESET_BRIGHT_FLAG:
-                _print_el(f, '\033[22m')
+            esc = []
+            if flag & C_BRIGHT_FLAG:
+                esc.append(_colbold)
+            elif flag & _C_RESET_BRIGHT_FLAG:
+                esc.append('\033[22m')
 
-            if color.flag & _C_RESET_FG_FLAG:
-                _print_el(f, '\033[39m')
-            elif color.fg is not None:
-                fg = _reduce(_cols, color.fg)
+            if flag & _C_RESET_FG_FLAG:
+                esc.append('\033[39m')
+            elif fg is not None:
+                fg = _reduce(_cols, fg)
 
                 if fg < 16:
-                    ansiC = ((fg & 1) << 2) + (fg & 2) + ((fg & 4) >> 2)
-                    if fg >= 8:
-                        if _cols >= 16:
-                            ansiC += 8
-                        else:
-                            _print_el(f, _colbold)
+                    if _cols >= 16:
+                        ansiC = _RGB_BIT_SWAP[fg]
+                    else:
+                        ansiC = _RGB_BIT_SWAP[fg & 7]
+                        if fg >= 8: esc.append(_colbold)
                 else:
                     ansiC = fg
-                _print_el(f, _cu.tparm(_afstr, ansiC).decode('ascii'))
+                esc.append(_afcodes[ansiC] if ansiC < len(_afcodes) else _cu.tparm(_afstr, ansiC).decode('ascii'))
 
-            if color.flag & _C_RESET_BG_FLAG:
-                _print_el(f, '\033[49m')
-            elif color.bg is not None:
-                bg = _reduce(_cols, color.bg)
+            if flag & _C_RESET_BG_FLAG:
+                esc.append('\033[49m')
+            elif bg is not None:
+                bg = _reduce(_cols, bg)
 
                 if bg < 16:
-                    ansiC = ((bg & 1) << 2) + (bg & 2) + ((bg & 4) >> 2);
-                    if _cols >= 16 and (bg & 8):
-                        ansiC += 8
+                    ansiC = _RGB_BIT_SWAP[bg if _cols >= 16 else bg & 7]
                 else:
                     ansiC = bg
-                _print_el(f, _cu.tparm(_abstr, ansiC).decode('ascii'))
+                esc.append(_abcodes[ansiC] if ansiC < len(_abcodes) else _cu.tparm(_abstr, ansiC).decode('ascii'))
+
+            return ''.join(esc)
 
     else:
         # Assume the usual ANSI codes will work
         _use_ansi_fallback()
 
-    _need_flush = False
+    _need_flush = ()
 
 
 def canPrintColor(file=_sys.stdout):
@@ -764,7 +930,104 @@ def willPrintColor(file=_sys.stdout):
     return _istty(file)
 
 
-def printc(*args, **kwargs):
+def _print_args(args, sep0, file, buf, con):
+    """ Appends the output for printc arguments to buf.
+
+    Returns True if the color has to be reset afterwards. """
+    set_color = _set_color
+    append = buf.append
+    Color_, Span_ = Color, Span
+    # only reset the color at the end if we changed it
+    need_reset = False
+    # last color set, if setting it again would change nothing
+    last = None
+    # colors without flags, merged into one color change. Colors with flags are applied one
+    # by one: C_BLUE, C_BRIGHT is not the same as C_BLUE + C_BRIGHT.
+    pending = None
+    sep = None
+    for s in args:
+        t = type(s)
+        if t is Color_ and not s.flag:
+            if s._bool:
+                pending = s if pending is None else pending + s
+            continue
+
+        if pending is not None:
+            if pending is not last:
+                set_color(pending, file, buf, con)
+                need_reset = True
+                last = pending
+            pending = None
+
+        if t is Color_:
+            set_color(s, file, buf, con)
+            need_reset = not (s.flag & _C_RESET_ALL_FLAG)
+            # flags are not idempotent, eg. C_BRIGHT twice is color 9 plus bold
+            last = None
+        else:
+            # handle separators. Colors do not trigger
+            # separators
+            if sep is not None:
+                append(sep)
+
+            if t is str:
+                append(s)
+            elif t is Span_:
+                if s._print(file, buf, con):
+                    need_reset = False
+                    last = None
+            else:
+                append(str(s))
+
+            sep = sep0
+
+    if pending is not None and pending is not last:
+        set_color(pending, file, buf, con)
+        need_reset = True
+    return need_reset
+
+
+class Span:
+    """
+    A fixed sequence of text and Color objects, for printing the same thing many times.
+
+    Pass it to printc() like any other argument. The output is worked out only once per output
+    mode and then printed as is, except on a legacy Windows console, where it is printed piece by
+    piece. If the span sets any colors, they are reset at the end of the span.
+
+    Without color, a span prints as its text separated by sep.
+    """
+    def __init__(self, *args, sep=' '):
+        self.args = args
+        self.sep = sep
+        # True if printing this span changes the color, and therefore leaves it reset
+        self._resets = any(type(s) is Color and s._bool or type(s) is Span and s._resets
+                           for s in args)
+        # output per color setter
+        self._rendered = {}
+
+    def _print(self, file, buf, con):
+        """ Appends the output to buf. Returns True if the color was reset. """
+        if _colorMode(file) == "win32":
+            # console attributes can't be stored in a string
+            if _print_args(self.args, self.sep, file, buf, con):
+                _set_color(C_RESET, file, buf, con)
+            return self._resets
+        s = self._rendered.get(_set_color)
+        if s is None:
+            b = []
+            if _print_args(self.args, self.sep, file, b, con):
+                _set_color(C_RESET, file, b, con)
+            s = self._rendered[_set_color] = ''.join(b)
+        buf.append(s)
+        return self._resets
+
+    # str(self)
+    def __str__(self):
+        return self.sep.join(str(s) for s in self.args if type(s) is not Color)
+
+
+def printc(*args, sep=' ', end='\n', file=None, flush=False):
     """ Analog to the print() function, but accepts Color objects to change colors
 
     Any Color objects will cause the output color to change for subsequent text.
@@ -775,45 +1038,54 @@ def printc(*args, **kwargs):
 
     If color is off, the call is equivalent to
 
-        print(*[s for s in args if type(s) is not Color], **kwargs)
+        print(*[s for s in args if type(s) is not Color], sep=sep, end=end, file=file, flush=flush)
     """
-    file = kwargs.get('file', _sys.stdout)
-    use = willPrintColor(file)
+    # nothing to color: leave it to print()
+    for s in args:
+        t = type(s)
+        if t is Color or t is Span:
+            break
+    else:
+        print(*args, sep=sep, end=end, file=file, flush=flush)
+        return
+
+    if file is None:
+        file = _sys.stdout
+    try:
+        use = _will_print[file]
+    except KeyError:
+        use = _will_print[file] = willPrintColor(file)
+    except TypeError:
+        # file object which can't be weakly referenced or hashed
+        use = willPrintColor(file)
     if not use:
         # strip all color objects and print
         ss = [s for s in args if type(s) is not Color]
-        print(*ss, **kwargs)
+        print(*ss, sep=sep, end=end, file=file, flush=flush)
         return
 
-    sep0 = str(kwargs.get('sep', ' '))
-    end = str(kwargs.get('end', '\n'))
-
-    try:
-        if _need_flush: file.flush()
-
-        sep = None
-        for s in args:
+    # like print(), None means the default
+    if sep is None: sep = ' '
+    if end is None: end = '\n'
 
-            if type(s) is Color:
-                if s:
-                    _set_color(s, file)
-            else:
-                # handle separators. Colors do not trigger
-                # separators
-                if sep is not None:
-                    _print_el(file, sep)
-                    sep = None
-
-                _print_el(file, str(s))
+    if file in _need_flush: file.flush()
 
-                sep = sep0
+    con = _con_for(file)
 
-    finally:
-        _set_color(C_RESET, file)
+    # collect the output, and write it in one go
+    buf = []
+    try:
+        need_reset = _print_args(args, sep, file, buf, con)
+    except:
+        _set_color(C_RESET, file, buf, con)
+        _print_el(file, ''.join(buf), con)
+        raise
 
-    _print_el(file, end)
+    if need_reset: _set_color(C_RESET, file, buf, con)
+    buf.append(end)
+    _print_el(file, ''.join(buf), con)
 
-    if kwargs.get('flush', False):
+    if flush:
         file.flush()
 
 
@@ -840,8 +1112,11 @@ if __name__ == "__main__":
         else:
             return 5
 
+    has_256 = numColors() >= 256
+
+    @_functools.lru_cache(maxsize=256)
     def rainbow(i):
-        if numColors() >= 256:
+        if has_256:
             r = ramp(i // 2)
             g = ramp(i // 2 - 10)
             b = ramp(i // 2 - 20)
@@ -849,10 +1124,10 @@ if __name__ == "__main__":
         return C_RESET
 
     rowI = 0
-    printc(rainbow(0), "╔", end='')
+    border = []
     for i in range(1, 77):
-        printc(rainbow(i), "═", end='')
-    printc(rainbow(78), "╗")
+        border += (rainbow(i), "═")
+    printc(rainbow(0), "╔", *border, rainbow(78), "╗", sep='')
 
     rowI += 2
     printc(rainbow(rowI),  "║", C_RESET,"  This is the ", end="")
@@ -876,10 +1151,10 @@ if __name__ == "__main__":
         printc(rainbow(rowI), "║", C_RESET, "  {:72s}".format(s) , rainbow(78+rowI), "║")
 
     rowI += 2
-    printc(rainbow(rowI), "╚", end='')
+    border = []
     for i in range(1, 77):
-        printc(rainbow(i+rowI), "═", end='')
-    printc(rainbow(78+rowI), "╝")
+        border += (rainbow(i+rowI), "═")
+    printc(rainbow(rowI), "╚", *border, rainbow(78+rowI), "╝", sep='')
 
     if not canPrintColor(_sys.stdout):
         print("Current stdout cannot print colors")
@@ -894,43 +1169,46 @@ if __name__ == "__main__":
         printc(C_BRIGHT, "--info", C_RESET, "and", C_BRIGHT, "--test", C_RESET, "print extra information.")
 
     if "--test" in _sys.argv:
+        # cells with a foreground color start with C_RESET: on 8-color terminals bright colors
+        # are drawn bold, and that would carry over to the next cell.
         print()
-        printc("256-color gray ramp: fg: ", end='')
+        row = []
         for i in range(232, 256):
-            printc(Color.fg(i), "██", end='')
-        printc()
-        printc("                     bg: ", end='')
+            row += (C_RESET, Color.fg(i), "██")
+        printc("256-color gray ramp: fg: ", *row, sep='')
+        row = []
         for i in range(232, 256):
-            printc(Color.bg(i), "  ", end='')
-        printc()
+            row += (Color.bg(i), "  ")
+        printc("                     bg: ", *row, sep='')
         printc()
 
         for j in range(0, 6, 2):
-            printc("256-color RGB cube: " if j == 2 else "                    ", end='')
+            row = []
             for i in range(16, 232, 6):
-                printc(Color.bg(i + j), Color.fg(i+j+1), "▄", end='')
-            printc()
+                row += (C_RESET, Color.bg(i + j), Color.fg(i+j+1), "▄")
+            printc("256-color RGB cube: " if j == 2 else "                    ", *row, sep='')
         printc()
 
+        steps = range(0, 256, 9)
         for i, (rgb_bg, rgb_fg) in enumerate((
             ((255, 0, 60), (255, 128, 0) ),
             ((255, 220, 0), (0, 255, 100)),
             ((0, 150, 255), (80, 0, 255)),
             ((180, 0, 255), (128, 128, 128))
             )):
-            printc("True-color ramps: " if i == 1 else "                  ", end='')
-            for i in range(0, 256, 9):
-                printc(
-                    Color.fg24(i * rgb_fg[0] // 255, i * rgb_fg[1] // 255, i * rgb_fg[2] // 255),
-                    Color.bg24(i * rgb_bg[0] // 255, i * rgb_bg[1] // 255, i * rgb_bg[2] // 255),
-                    "▄", end='')
-            for i in range(0, 256, 9):
-                t = 255 - i
-                printc(
-                    Color.fg24(i + t * rgb_fg[0] // 255, i + t * rgb_fg[1] // 255, i + t * rgb_fg[2] // 255),
-                    Color.bg24(i + t * rgb_bg[0] // 255, i + t * rgb_bg[1] // 255, i + t * rgb_bg[2] // 255),
-                    "▄", end='')
-            printc()
+            row = []
+            for v in steps:
+                row += (C_RESET,
+                        Color.fg24(*(v * c // 255 for c in rgb_fg)),
+                        Color.bg24(*(v * c // 255 for c in rgb_bg)),
+                        "▄")
+            for v in steps:
+                t = 255 - v
+                row += (C_RESET,
+                        Color.fg24(*(v + t * c // 255 for c in rgb_fg)),
+                        Color.bg24(*(v + t * c // 255 for c in rgb_bg)),
+                        "▄")
+            printc("True-color ramps: " if i == 1 else "                  ", *row, sep='')
         printc()
 
         printc("16-color behavior: ", end='')
@@ -956,25 +1234,17 @@ if __name__ == "__main__":
 
     if "--chart256" in _sys.argv or "--chart256bg" in _sys.argv:
         C = (lambda x : Color.make(0, x)) if "--chart256bg" in _sys.argv else Color.fg
+        cells = [Span(C(i), "{:03}".format(i)) for i in range(256)]
 
         print()
-        for i in range(16):
-            printc(C(i), "{:03}".format(i), end=' ')
-        printc()
+        printc(*cells[:16], end=' \n')
         printc()
 
-        for a in range(6):
-            for b in range(6):
-                for c in range(6):
-                    i = 16 + c + 6*(b + 6*a)
-                    printc(C(i), "{:03}".format(i), end=' ')
-                printc()
+        for a in range(16, 232, 36):
+            for b in range(a, a + 36, 6):
+                printc(*cells[b:b+6], end=' \n')
             printc()
         printc()
 
-        for i in range(232, 244):
-            printc(C(i), "{:03}".format(i), end=' ')
-        printc()
-        for i in range(244, 256):
-            printc(C(i), "{:03}".format(i), end=' ')
-        printc()
+        printc(*cells[232:244], end=' \n')
+        printc(*cells[244:256], end=' \n')